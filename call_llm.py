@@ -1,19 +1,27 @@
-import os
+import json
 from openai import OpenAI
 from anthropic import Anthropic
+from anthropic.types import Message
 from sqlalchemy import text
 from database import engine
+from config import OPENAI_API_KEY, ANTHROPIC_API_KEY, DEEPSEEK_API_KEY
+from clients import get_client
 from generate_prompt import create_rfp_prompt, convert_prompt_to_claude, find_similar_matches_and_generate_prompt
 import logging
 import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import singledispatch
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+@singledispatch
 def extract_text(response):
     """
     Extract clean text from Claude's TextBlock response.
+    Anthropic Message objects and plain strings take the fast paths
+    registered below; this generic version handles any other shape.
 
     Args:
         response: Response object from Claude API
@@ -138,6 +146,76 @@ def extract_text(response):
     print(f"==== END EXTRACT_TEXT DEBUG ====\n")
     return result
 
+@extract_text.register
+def _(response: str):
+    return response
+
+@extract_text.register
+def _(response: Message):
+    # Content blocks carry a type tag, so no per-block hasattr probing is needed
+    result = ' '.join(block.text for block in response.content if block.type == 'text')
+    if result:
+        return result
+    return extract_text.dispatch(object)(response)
+
+# Retries for rate limits (429), server errors (5xx), timeouts and connection
+# errors, one more than the SDK default; the SDKs back off exponentially with
+# jitter and honour Retry-After. The request timeout stays at the SDK default,
+# since each route that spawns call_llm_wrapper enforces its own deadline
+LLM_MAX_RETRIES = 3
+
+# Configuration map for supported models, built once at import
+MODEL_CONFIGS = {
+    'openai': {
+        'normalized_name': 'openai',
+        'display_name': 'OpenAI',
+        'client_class': OpenAI,
+        'client_args': {
+            'api_key': OPENAI_API_KEY,
+        },
+        'client_kwargs': {'max_retries': LLM_MAX_RETRIES},
+        'completion_args': {
+            'model': 'gpt-5.1',
+            'temperature': 0.2
+        },
+        'requires_system_message_handling': False,
+        'use_responses_api': True,  # Use Responses API for GPT-4.1
+        'response_handler': lambda response: response.output_text.strip() if hasattr(response, 'output_text') else str(response)
+    },
+    'deepseek': {
+        'normalized_name': 'deepseek',
+        'display_name': 'DeepSeek',
+        'client_class': OpenAI,
+        'client_args': {
+            'api_key': DEEPSEEK_API_KEY,
+            'base_url': "https://api.deepseek.com/v1",
+        },
+        'client_kwargs': {'max_retries': LLM_MAX_RETRIES},
+        'completion_args': {
+            'model': 'deepseek-chat',
+            'temperature': 0.2
+        },
+        'requires_system_message_handling': False,
+        'response_handler': lambda response: response.choices[0].message.content.strip()
+    },
+    'anthropic': {
+        'normalized_name': 'anthropic',
+        'display_name': 'Anthropic',
+        'client_class': Anthropic,
+        'client_args': {
+            'api_key': ANTHROPIC_API_KEY,
+        },
+        'client_kwargs': {'max_retries': LLM_MAX_RETRIES},
+        'completion_args': {
+            'model': "claude-sonnet-4-5",
+            'max_tokens': 4000,
+            'temperature': 0.2
+        },
+        'requires_system_message_handling': True,
+        'response_handler': extract_text
+    }
+}
+
 def get_model_config(model_name):
     """
     Return configuration for a specific model.
@@ -155,61 +233,9 @@ def get_model_config(model_name):
     if normalized_name == 'claude':
         normalized_name = 'anthropic'
     
-    # Configuration map for supported models
-    model_configs = {
-        'openai': {
-            'display_name': 'OpenAI',
-            'client_class': OpenAI,
-            'client_args': {
-                'api_key': os.environ.get("OPENAI_API_KEY"),
-            },
-            'client_kwargs': {},
-            'completion_args': {
-                'model': 'gpt-5.1',
-                'temperature': 0.2
-            },
-            'requires_system_message_handling': False,
-            'use_responses_api': True,  # Use Responses API for GPT-4.1
-            'response_handler': lambda response: response.output_text.strip() if hasattr(response, 'output_text') else str(response)
-        },
-        'deepseek': {
-            'display_name': 'DeepSeek',
-            'client_class': OpenAI,
-            'client_args': {
-                'api_key': os.environ.get("DEEPSEEK_API_KEY"),
-                'base_url': "https://api.deepseek.com/v1",
-            },
-            'client_kwargs': {},
-            'completion_args': {
-                'model': 'deepseek-chat',
-                'temperature': 0.2
-            },
-            'requires_system_message_handling': False,
-            'response_handler': lambda response: response.choices[0].message.content.strip()
-        },
-        'anthropic': {
-            'display_name': 'Anthropic',
-            'client_class': Anthropic,
-            'client_args': {
-                'api_key': os.environ.get("ANTHROPIC_API_KEY"),
-            },
-            'client_kwargs': {},
-            'completion_args': {
-                'model': "claude-sonnet-4-5",
-                'max_tokens': 4000,
-                'temperature': 0.2
-            },
-            'requires_system_message_handling': True,
-            'response_handler': extract_text
-        }
-    }
-    
     # Return the configuration for the requested model
-    if normalized_name in model_configs:
-        config = model_configs[normalized_name]
-        # Add the normalized name to the config
-        config['normalized_name'] = normalized_name
-        return config
+    if normalized_name in MODEL_CONFIGS:
+        return MODEL_CONFIGS[normalized_name]
     else:
         raise ValueError(f"Unsupported model: {model_name}")
 
@@ -239,8 +265,8 @@ def prompt_gpt(prompt, model_name='openAI'):
         
         # Initialize the client with the configuration
         try:
-            client = config['client_class'](**config['client_args'], **config.get('client_kwargs', {}))
-            logger.info(f"{display_name} client initialized successfully")
+            client = get_client(config['client_class'], **config['client_args'], **config.get('client_kwargs', {}))
+            logger.info(f"{display_name} client ready")
         except Exception as e:
             logger.error(f"Failed to initialize {display_name} client: {str(e)}")
             raise ValueError(f"Failed to initialize {display_name} client: {str(e)}")
@@ -458,6 +484,19 @@ If any check fails, revise the response accordingly."""
 
     return [system_message, user_message, validation_message]
 
+def _saved_response(row):
+    """Map the row returned by a save query's RETURNING clause, or None if nothing was updated."""
+    if row is None:
+        return None
+    return {
+        "id": row[0],
+        "final_response": row[1],
+        "openai_response": row[2],
+        "anthropic_response": row[3],
+        "deepseek_response": row[4],
+        "model_provider": row[5]
+    }
+
 def get_llm_responses(requirement_id, model='moa', display_results=True, skip_similarity_search=False):
     """
     Get LLM responses for a given requirement.
@@ -468,6 +507,9 @@ def get_llm_responses(requirement_id, model='moa', display_results=True, skip_si
                If 'moa', responses from all models will be synthesized
         display_results: Whether to display the results after fetching
         skip_similarity_search: If True, skips finding similar matches and uses existing ones in the database
+    
+    Returns:
+        Dict whose saved_response holds the response columns as written by the save
     """
     print(f"\n\n==== RESPONSE GENERATION PROCESS ====")
     print(f"Processing requirement ID: {requirement_id}")
@@ -506,9 +548,13 @@ def get_llm_responses(requirement_id, model='moa', display_results=True, skip_si
                     existing_similar = connection.execute(existing_similar_query, {"req_id": requirement_id}).fetchone()
                     if existing_similar and existing_similar[0]:
                         print("Found existing similar questions in database")
-                        # Parse the existing similar questions string back to a list
-                        import ast
-                        similar_questions_list = ast.literal_eval(existing_similar[0])
+                        # Parse the existing similar questions JSON back to a list
+                        try:
+                            similar_questions_list = json.loads(existing_similar[0])
+                        except json.JSONDecodeError:
+                            # Older rows were stored as a Python repr
+                            import ast
+                            similar_questions_list = ast.literal_eval(existing_similar[0])
                         
                         print(f"DEBUG: Similar questions loaded from database (first example): {similar_questions_list[0] if similar_questions_list else 'None'}")
                         
@@ -545,7 +591,7 @@ def get_llm_responses(requirement_id, model='moa', display_results=True, skip_si
                     from find_matches import find_similar_matches
                     
                     print("2. Calling find_similar_matches to get proper customer names...")
-                    matches_result = find_similar_matches(requirement_id)
+                    matches_result = find_similar_matches(requirement_id, connection, requirement)
                     
                     if matches_result.get('success') and matches_result.get('similar_matches'):
                         # Convert the matches to the format expected by the rest of the code
@@ -621,14 +667,15 @@ def get_llm_responses(requirement_id, model='moa', display_results=True, skip_si
                         model_provider = :model_provider,
                         timestamp = NOW()
                     WHERE id = :req_id
+                    RETURNING id, final_response, openai_response, anthropic_response, deepseek_response, model_provider
                 """)
                 
-                connection.execute(no_ref_save_query, {
+                saved = connection.execute(no_ref_save_query, {
                     "req_id": requirement_id,
                     "final_response": NO_REFERENCE_MESSAGE,
                     "similar_questions": "[]",
                     "model_provider": model
-                })
+                }).fetchone()
                 connection.commit()
                 
                 # Return the result
@@ -640,7 +687,8 @@ def get_llm_responses(requirement_id, model='moa', display_results=True, skip_si
                     "final_response": NO_REFERENCE_MESSAGE,
                     "similar_questions": [],
                     "model_provider": model,
-                    "no_references": True
+                    "no_references": True,
+                    "saved_response": _saved_response(saved)
                 }
 
             # Generate prompts based on model
@@ -673,18 +721,22 @@ def get_llm_responses(requirement_id, model='moa', display_results=True, skip_si
                     {'name': 'anthropic', 'prompt': claude_prompt}
                 ]
                 
-                # Get responses from each model
-                for model_info in models:
-                    model_name = model_info['name']
-                    model_prompt = model_info['prompt']
+                # Get responses from each model concurrently; the calls are
+                # network-bound, so wall time is the slowest provider, not the sum
+                with ThreadPoolExecutor(max_workers=len(models)) as executor:
+                    futures = {}
+                    for model_info in models:
+                        print(f"Generating response from {model_info['name']}...")
+                        futures[executor.submit(prompt_gpt, model_info['prompt'], model_info['name'])] = model_info['name']
                     
-                    try:
-                        print(f"Generating response from {model_name}...")
-                        model_responses[model_name] = prompt_gpt(model_prompt, model_name)
-                        print(f"Successfully generated {model_name} response")
-                    except Exception as e:
-                        print(f"Error generating {model_name} response: {str(e)}")
-                        model_responses[model_name] = None
+                    for future in as_completed(futures):
+                        model_name = futures[future]
+                        try:
+                            model_responses[model_name] = future.result()
+                            print(f"Successfully generated {model_name} response")
+                        except Exception as e:
+                            print(f"Error generating {model_name} response: {str(e)}")
+                            model_responses[model_name] = None
                 
                 # Assign responses to variables for backward compatibility
                 openai_response = model_responses.get('openai')
@@ -728,17 +780,18 @@ def get_llm_responses(requirement_id, model='moa', display_results=True, skip_si
                         model_provider = :model_provider,
                         timestamp = NOW()
                     WHERE id = :req_id
+                    RETURNING id, final_response, openai_response, anthropic_response, deepseek_response, model_provider
                 """)
 
-                connection.execute(save_query, {
+                saved = connection.execute(save_query, {
                     "req_id": requirement_id,
                     "openai_response": openai_response,
                     "deepseek_response": deepseek_response,
                     "anthropic_response": claude_response,
                     "final_response": final_response,
-                    "similar_questions": str(similar_questions_list),
+                    "similar_questions": json.dumps(similar_questions_list),
                     "model_provider": model
-                })
+                }).fetchone()
                 connection.commit()
                 print("5. Responses saved successfully")
 
@@ -809,15 +862,16 @@ def get_llm_responses(requirement_id, model='moa', display_results=True, skip_si
                         model_provider = :normalized_model,
                         timestamp = NOW()
                     WHERE id = :req_id
+                    RETURNING id, final_response, openai_response, anthropic_response, deepseek_response, model_provider
                 """)
 
                 print(f"Executing database update with model: {normalized_model}")
-                connection.execute(save_query, {
+                saved = connection.execute(save_query, {
                     "req_id": requirement_id,
                     "response": response,
                     "normalized_model": normalized_model,
-                    "similar_questions": str(similar_questions_list)
-                })
+                    "similar_questions": json.dumps(similar_questions_list)
+                }).fetchone()
                 
                 # Log what was updated for debugging
                 print(f"Updated {normalized_model}_response column and final_response with response length: {len(response)}")
@@ -835,6 +889,12 @@ def get_llm_responses(requirement_id, model='moa', display_results=True, skip_si
                 print("\nFinal Response:")
                 print(final_response if model == 'moa' else response)
 
+            return {
+                "success": True,
+                "requirement_id": requirement_id,
+                "saved_response": _saved_response(saved)
+            }
+
     except Exception as e:
         print(f"\nError in get_llm_responses: {str(e)}")
         raise
@@ -7,8 +7,6 @@ import sys
 import json
 import traceback
 from call_llm import get_llm_responses
-from sqlalchemy import text
-from database import engine
 
 def main():
     if len(sys.argv) < 4:
@@ -29,43 +27,28 @@ def main():
         if model.lower() not in allowed_models:
             raise ValueError(f'Invalid model: {model}. Allowed: {allowed_models}')
         
-        # Call the LLM function
-        get_llm_responses(requirement_id, model, False, skip_similarity_search)
+        # Call the LLM function; the saved columns come back from the UPDATE itself
+        result = get_llm_responses(requirement_id, model, False, skip_similarity_search)
+        saved = result.get('saved_response') if result else None
         
-        # Fetch the response from database
-        with engine.connect() as connection:
-            query = text('''
-                SELECT 
-                    id, 
-                    final_response, 
-                    openai_response, 
-                    anthropic_response, 
-                    deepseek_response,
-                    model_provider
-                FROM excel_requirement_responses 
-                WHERE id = :req_id
-            ''')
-            
-            result = connection.execute(query, {'req_id': requirement_id}).fetchone()
-            
-            if result:
-                response_data = {
-                    'id': result[0],
-                    'finalResponse': result[1],
-                    'openaiResponse': result[2], 
-                    'anthropicResponse': result[3],
-                    'deepseekResponse': result[4],
-                    'modelProvider': result[5] or model,
-                    'success': True,
-                    'message': 'Response generated successfully'
-                }
-                print(json.dumps(response_data))
-            else:
-                print(json.dumps({
-                    'success': False,
-                    'error': 'No response found after generation'
-                }))
-                sys.exit(1)
+        if saved:
+            response_data = {
+                'id': saved['id'],
+                'finalResponse': saved['final_response'],
+                'openaiResponse': saved['openai_response'], 
+                'anthropicResponse': saved['anthropic_response'],
+                'deepseekResponse': saved['deepseek_response'],
+                'modelProvider': saved['model_provider'] or model,
+                'success': True,
+                'message': 'Response generated successfully'
+            }
+            print(json.dumps(response_data))
+        else:
+            print(json.dumps({
+                'success': False,
+                'error': 'No response found after generation'
+            }))
+            sys.exit(1)
                 
     except ValueError as e:
         error_details = {
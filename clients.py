@@ -0,0 +1,27 @@
+"""
+Shared API clients, reused across calls so each provider keeps its HTTP
+connection pool and TLS session
+"""
+import threading
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def get_client(client_class, **client_args):
+    """
+    Return the shared client for a client class and arguments, creating it on first use.
+
+    Args:
+        client_class: The SDK client class (e.g. OpenAI, Anthropic)
+        **client_args: Keyword arguments for the client constructor
+
+    Returns:
+        The provider's API client
+    """
+    key = (client_class, tuple(sorted(client_args.items())))
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = client_class(**client_args)
+            _clients[key] = client
+        return client
@@ -1,8 +1,15 @@
 import os
 import logging
-from sqlalchemy import create_engine
+import numpy as np
+from sqlalchemy import create_engine, event
 from sqlalchemy.sql import text
 
+try:
+    from pgvector.psycopg2 import register_vector
+except ImportError:
+    # The pgvector Python package is optional; without it vectors are sent as text literals
+    register_vector = None
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -13,14 +20,69 @@ database_url = os.environ.get('DATABASE_URL')
 if not database_url:
     raise ValueError("DATABASE_URL environment variable is not set")
 
+# Seconds to wait for a TCP connection before failing, instead of the
+# platform's default of a minute or more when the host is unreachable
+DB_CONNECT_TIMEOUT = 5
+
+# Upper bound on any single statement run by this process
+DB_STATEMENT_TIMEOUT = '30s'
+
 # Create the SQLAlchemy engine
+# Pooled connections are pinged on checkout and recycled after five minutes,
+# so connections the server or pooler has dropped while idle are replaced
 try:
-    engine = create_engine(database_url)
+    engine = create_engine(
+        database_url,
+        pool_pre_ping=True,
+        pool_recycle=300,
+        pool_size=5,
+        max_overflow=5,
+        connect_args={'connect_timeout': DB_CONNECT_TIMEOUT}
+    )
     logger.info("Database engine created successfully")
 except Exception as e:
     logger.error(f"Error creating database engine: {str(e)}")
     raise
 
+# Register the pgvector adapter once for every new DBAPI connection
+if register_vector is not None:
+    @event.listens_for(engine, "connect")
+    def _register_vector_adapter(dbapi_connection, connection_record):
+        try:
+            register_vector(dbapi_connection)
+        except Exception as e:
+            logger.warning(f"Could not register pgvector adapter: {str(e)}")
+
+# Applied with SET LOCAL at the start of every transaction: Neon's pooled
+# endpoint (PgBouncer in transaction mode) rejects startup options and does not
+# keep session settings, and a local setting ends with the transaction, so
+# other clients of the database role are unaffected
+@event.listens_for(engine, "begin")
+def _set_statement_timeout(conn):
+    cursor = conn.connection.cursor()
+    try:
+        cursor.execute("SET LOCAL statement_timeout = %s", (DB_STATEMENT_TIMEOUT,))
+    finally:
+        cursor.close()
+
+def to_pgvector(embedding):
+    """
+    Convert an embedding into a bind parameter for a pgvector column.
+
+    Args:
+        embedding: Sequence of floats or numpy array
+
+    Returns:
+        A float32 numpy array when the pgvector adapter is installed,
+        otherwise a pgvector text literal such as '[0.1,0.2,...]'
+    """
+    vector = np.asarray(embedding, dtype=np.float32)
+    if register_vector is not None:
+        return vector
+    # Nine significant digits round-trip float32 exactly; str() would print
+    # up to 17 digits of float64 noise per element
+    return '[' + ','.join(map('{:.9g}'.format, vector.tolist())) + ']'
+
 # Test the connection
 def test_connection():
     try:
@@ -36,6 +98,34 @@ def test_connection():
         logger.error(f"Error testing database connection: {str(e)}")
         return False
 
+# HNSW index created by migrate.sql for similarity search
+VECTOR_INDEX_NAME = 'embeddings_emb_halfvec_ip_hnsw'
+
+def check_vector_index():
+    """
+    Check that the HNSW index for similarity search exists.
+    Without it Postgres falls back to a sequential scan and a full sort of
+    every embedding, so a warning is logged.
+
+    Returns:
+        True if the index exists, False otherwise
+    """
+    try:
+        with engine.connect() as connection:
+            found = connection.execute(text("""
+                SELECT 1 FROM pg_indexes
+                WHERE tablename = 'embeddings' AND indexname = :index_name
+            """), {"index_name": VECTOR_INDEX_NAME}).fetchone()
+        if found:
+            logger.info(f"Similarity search index {VECTOR_INDEX_NAME} is present")
+            return True
+        logger.warning(f"Similarity search index {VECTOR_INDEX_NAME} is missing; run migrate.sql")
+        return False
+    except Exception as e:
+        logger.error(f"Error checking vector index: {str(e)}")
+        return False
+
 # If this file is run directly, test the connection
 if __name__ == "__main__":
-    test_connection()
\ No newline at end of file
+    if test_connection():
+        check_vector_index()
\ No newline at end of file
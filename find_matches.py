@@ -2,7 +2,10 @@ import json
 import logging
 import sys
 import time
-from database import engine
+import numpy as np
+from config import OPENAI_API_KEY
+from database import engine, to_pgvector
+from generate_embeddings import EmbeddingGenerator
 from sqlalchemy import text
 
 # Configure more detailed logging
@@ -15,72 +18,169 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-def find_similar_matches(requirement_id):
+# Size of the HNSW candidate list searched per query, by embeddings table size:
+# below 100k rows 40 (pgvector default), below 1M rows 100, otherwise 200
+HNSW_EF_SEARCH_SMALL = (100000, 40)
+HNSW_EF_SEARCH_MEDIUM = (1000000, 100)
+HNSW_EF_SEARCH_LARGE = 200
+# An HNSW scan returns at most ef_search rows, so it is raised to the number of
+# rerank candidates when that is larger, up to pgvector's maximum of 1000
+HNSW_EF_SEARCH_MAX = 1000
+
+# Matches returned per requirement, and how many half-precision index
+# candidates are fetched per match before the exact full-precision rerank
+SIMILAR_MATCH_LIMIT = 5
+RERANK_OVERSAMPLE = 4
+
+# Batched searches returning at least this many rows are streamed in chunks
+# of BATCH_STREAM_YIELD_PER rows instead of being fetched in one go
+BATCH_STREAM_MIN_ROWS = 10000
+BATCH_STREAM_YIELD_PER = 1000
+
+def _max_distance(min_similarity):
+    """
+    Translate an optional minimum similarity score into a bound on the
+    negative inner product that <#> returns; no minimum means no bound.
+    """
+    if min_similarity is None:
+        return float('inf')
+    return -float(min_similarity)
+
+def _set_hnsw_ef_search(connection, candidates):
+    """
+    Set hnsw.ef_search for the current transaction from the planner's row
+    estimate for the embeddings table, in the same round-trip as the SET,
+    and never below the number of candidates the query asks the index for.
+    """
+    connection.execute(text("""
+        SELECT set_config(
+            'hnsw.ef_search',
+            LEAST(GREATEST(
+                CASE
+                    WHEN c.reltuples < :small_rows THEN :small_ef
+                    WHEN c.reltuples < :medium_rows THEN :medium_ef
+                    ELSE :large_ef
+                END,
+                :candidates
+            ), :max_ef)::text,
+            true
+        )
+        FROM pg_class c
+        WHERE c.oid = 'embeddings'::regclass
+    """), {
+        "small_rows": HNSW_EF_SEARCH_SMALL[0],
+        "small_ef": HNSW_EF_SEARCH_SMALL[1],
+        "medium_rows": HNSW_EF_SEARCH_MEDIUM[0],
+        "medium_ef": HNSW_EF_SEARCH_MEDIUM[1],
+        "large_ef": HNSW_EF_SEARCH_LARGE,
+        "candidates": candidates,
+        "max_ef": HNSW_EF_SEARCH_MAX
+    })
+
+def find_similar_matches(requirement_id, connection=None, requirement=None, min_similarity=None):
     """
     Find similar matches for a requirement using vector similarity search.
     Also stores the similar matches in the similar_questions column of excel_requirement_responses.
     
     Args:
         requirement_id: The ID of the requirement to find matches for
+        connection: Optional open database connection to reuse; a pooled
+                    connection is checked out when not provided
+        requirement: Optional (id, requirement, category) row already fetched
+                     by the caller, to skip looking it up again
+        min_similarity: Optional minimum similarity score; weaker matches
+                        are filtered out in SQL instead of being returned
         
     Returns:
         Dict with requirement details and similar matches
     """
     logger.info(f"Finding similar matches for requirement ID: {requirement_id}")
+    shared_connection = connection
     try:
+        if shared_connection is not None:
+            return _find_similar_matches(shared_connection, requirement_id, requirement, min_similarity)
         with engine.connect() as connection:
-            # First, get the requirement details
-            req_query = text("""
-                SELECT r.id, r.requirement, r.category
-                FROM excel_requirement_responses r
-                WHERE r.id = :req_id
-            """)
-
-            # Get the requirement details
-            requirement = connection.execute(req_query, {"req_id": requirement_id}).fetchone()
-
-            if not requirement:
-                print(f"\nNo requirement found with ID: {requirement_id}")
-                return {
-                    "success": False,
-                    "error": f"No requirement found with ID: {requirement_id}"
-                }
-
-            # Log the requirement we're looking for
-            logger.info(f"Found requirement: {requirement}")
-            
-            # Generate embedding on-the-fly for this requirement (don't persist it)
-            # This keeps the embeddings table pristine with only 9,650 reference embeddings
-            requirement_text = requirement[1]
-            logger.info(f"Generating temporary embedding for requirement: {requirement_text[:100]}...")
-            
-            try:
-                from openai import OpenAI
-                import os
-                
-                client = OpenAI(api_key=os.environ.get('OPENAI_API_KEY'))
-                embedding_response = client.embeddings.create(
-                    model="text-embedding-3-small",
-                    input=requirement_text
-                )
-                requirement_embedding = embedding_response.data[0].embedding
-                logger.info(f"Generated temporary embedding (dimension: {len(requirement_embedding)})")
-                
-            except Exception as e:
-                logger.error(f"Error generating temporary embedding: {str(e)}")
-                return {
-                    "success": False,
-                    "error": f"Failed to generate embedding: {str(e)}"
-                }
-            
-            # Now find similar matches using the temporary embedding
-            # Search against the 9,650 reference embeddings ONLY
-            # Convert the embedding list to the format PostgreSQL expects
-            embedding_str = '[' + ','.join(map(str, requirement_embedding)) + ']'
-            
-            # We need to use a subquery with the embedding directly in the SQL
-            # since SQLAlchemy has issues with vector type parameter binding
-            similar_query = text(f"""
+            return _find_similar_matches(connection, requirement_id, requirement, min_similarity)
+    except Exception as e:
+        logger.error(f"Error finding similar matches: {str(e)}")
+        if shared_connection is not None:
+            # Leave the caller's connection usable after a failed statement
+            shared_connection.rollback()
+        return {
+            "success": False,
+            "error": str(e)
+        }
+
+def _find_similar_matches(connection, requirement_id, requirement=None, min_similarity=None):
+    """Run the similarity search for a requirement on an open connection."""
+    if requirement is None:
+        # First, get the requirement details
+        req_query = text("""
+            SELECT r.id, r.requirement, r.category
+            FROM excel_requirement_responses r
+            WHERE r.id = :req_id
+        """)
+
+        # Get the requirement details
+        requirement = connection.execute(req_query, {"req_id": requirement_id}).fetchone()
+
+    if not requirement:
+        print(f"\nNo requirement found with ID: {requirement_id}")
+        return {
+            "success": False,
+            "error": f"No requirement found with ID: {requirement_id}"
+        }
+
+    # Log the requirement we're looking for
+    logger.info(f"Found requirement: {requirement}")
+    
+    # Generate embedding on-the-fly for this requirement (don't persist it)
+    # This keeps the embeddings table pristine with only 9,650 reference embeddings
+    requirement_text = requirement[1]
+    logger.info(f"Generating temporary embedding for requirement: {requirement_text[:100]}...")
+    
+    try:
+        generator = EmbeddingGenerator(OPENAI_API_KEY)
+        # Convert once; the pgvector adapter takes the float32 array directly
+        requirement_embedding = np.asarray(generator.generate_embedding(requirement_text), dtype=np.float32)
+        logger.info(f"Generated temporary embedding (dimension: {len(requirement_embedding)})")
+        
+    except Exception as e:
+        logger.error(f"Error generating temporary embedding: {str(e)}")
+        return {
+            "success": False,
+            "error": f"Failed to generate embedding: {str(e)}"
+        }
+    
+    # Now find similar matches using the temporary embedding
+    # Search against the 9,650 reference embeddings ONLY
+    # The embedding is bound as a parameter; the pgvector adapter (when
+    # installed) adapts the numpy array directly instead of a hand-built literal
+    # The distance is computed once per row and the embedding is bound once.
+    # Candidates come from the half-precision HNSW index, oversampled by
+    # RERANK_OVERSAMPLE, and are reranked by exact full-precision distance.
+    # Stored embeddings are unit-length and the query is normalized once, so
+    # the inner product (<#> returns its negation) equals cosine similarity
+    similar_query = text("""
+        SELECT 
+            m.id,
+            m.matched_requirement,
+            m.matched_response,
+            m.category,
+            m.reference,
+            m.payload,
+            -m.distance as similarity_score
+        FROM (SELECT l2_normalize(CAST(:embedding AS vector)) AS v) q
+        CROSS JOIN LATERAL (
+            SELECT 
+                c.id,
+                c.matched_requirement,
+                c.matched_response,
+                c.category,
+                c.reference,
+                c.payload,
+                c.embedding <#> q.v as distance
+            FROM (
                 SELECT 
                     e.id,
                     e.requirement as matched_requirement,
@@ -88,129 +188,309 @@ def find_similar_matches(requirement_id):
                     e.category,
                     e.reference,
                     e.payload,
-                    1 - (e.embedding <=> '{embedding_str}'::vector) as similarity_score
+                    e.embedding
                 FROM embeddings e
                 WHERE e.embedding IS NOT NULL
-                ORDER BY similarity_score DESC
-                LIMIT 5;
-            """)
-
-            # Log that we're starting the similarity search
-            logger.info(f"Starting similarity search query for requirement ID: {requirement_id}")
-            start_time = time.time()
-            
-            # Execute the similarity search with the temporary embedding
-            # Using try/except to catch potential timeout issues
-            try:
-                similar_results = connection.execution_options(timeout=20).execute(
-                    similar_query
-                ).fetchall()
-                
-                elapsed_time = time.time() - start_time
-                logger.info(f"Similarity search completed in {elapsed_time:.2f} seconds")
-            except Exception as query_error:
-                elapsed_time = time.time() - start_time
-                logger.error(f"Similarity search failed after {elapsed_time:.2f} seconds: {str(query_error)}")
-                raise
-            
-            # Format results for return and database storage
-            formatted_results = []
-            similar_questions_for_db = []
-            
-            for result in similar_results:
-                # Extract fields from the database result
-                reference_field = result[4] if result[4] else ""  # Document name (e.g., "BDO RFI.xlsx_Sheet1")
-                category_field = result[3] if result[3] else ""   # Category/customer info
-                
-                # Document name is in the reference column - this is what we want to display
-                document_name = reference_field if reference_field else ""
-                
-                # Customer/category info from category field
-                customer_info = category_field if category_field else ""
-                
-                # Last resort: try payload for customer info
-                if not customer_info:
-                    try:
-                        if result[5]:  # payload field
-                            payload = json.loads(result[5])
-                            if payload.get('category'):
-                                customer_info = payload['category']
-                    except Exception as e:
-                        logger.debug(f"Could not parse payload for customer info: {e}")
-                
-                # Format for API response
-                formatted_results.append({
-                    "id": result[0],
-                    "requirement": result[1],
-                    "response": result[2],
-                    "category": customer_info,  # Category field for display
-                    "reference": document_name,  # Document name from reference column
-                    "customer": customer_info,   # Customer info for backwards compatibility
-                    "similarity_score": float(result[6])  # Updated index for similarity_score
-                })
-                
-                # Format for database storage (includes document name)
-                similar_questions_for_db.append({
-                    "question": result[1],
-                    "response": result[2],
-                    "reference": document_name,  # Use document name instead of "Match #X"
-                    "customer": customer_info,
-                    "similarity_score": f"{float(result[6]):.4f}"  # Updated index
-                })
-            
-            # Store the similar questions in the database
-            if similar_questions_for_db:
-                # Convert to JSON string for storage
-                similar_questions_json = json.dumps(similar_questions_for_db)
-                
-                # Update the similar_questions column in the database
-                update_query = text("""
-                    UPDATE excel_requirement_responses
-                    SET similar_questions = :similar_questions
-                    WHERE id = :req_id
-                """)
-                
-                connection.execute(update_query, {
-                    "req_id": requirement_id,
-                    "similar_questions": similar_questions_json
-                })
-                
-                # Commit the transaction
-                connection.commit()
-                logger.info(f"Updated similar_questions in database for requirement ID: {requirement_id}")
-            
-            # For debug/console output in logs only
-            logger.info(f"Original Requirement: ID={requirement[0]}, Category={requirement[2]}")
-            logger.info(f"Requirement text: {requirement[1]}")
-            logger.info(f"Found {len(similar_results)} similar matches")
-            
-            # Log the results for debugging but don't print to stdout
-            for idx, result in enumerate(similar_results, 1):
-                logger.info(f"Match #{idx}")
-                logger.info(f"ID: {result[0]}")
-                logger.info(f"Category: {result[3]}")
-                logger.info(f"Similarity Score: {float(result[6]):.4f}")
-                logger.info(f"Requirement: {result[1]}")
-                logger.info(f"Response: {result[2][:100]}...") # Log only the first 100 chars
-                logger.info("-" * 40)
-            
-            # Return structured data
-            return {
-                "success": True,
-                "requirement": {
-                    "id": requirement[0],
-                    "text": requirement[1],
-                    "category": requirement[2]
-                },
-                "similar_matches": formatted_results
+                ORDER BY e.embedding::halfvec(1536) <#> q.v::halfvec(1536)
+                LIMIT :candidates
+            ) c
+            ORDER BY distance
+            LIMIT :limit
+        ) m
+        WHERE m.distance <= :max_distance
+        ORDER BY m.distance;
+    """)
+
+    # Log that we're starting the similarity search
+    logger.info(f"Starting similarity search query for requirement ID: {requirement_id}")
+    start_time = time.time()
+    
+    # Execute the similarity search with the temporary embedding
+    # Using try/except to catch potential timeout issues
+    try:
+        # Candidate list size for the HNSW index scan (transaction-scoped)
+        _set_hnsw_ef_search(connection, SIMILAR_MATCH_LIMIT * RERANK_OVERSAMPLE)
+        similar_results = connection.execution_options(timeout=20).execute(
+            similar_query, {
+                "embedding": to_pgvector(requirement_embedding),
+                "limit": SIMILAR_MATCH_LIMIT,
+                "candidates": SIMILAR_MATCH_LIMIT * RERANK_OVERSAMPLE,
+                "max_distance": _max_distance(min_similarity)
             }
+        ).fetchall()
+        
+        elapsed_time = time.time() - start_time
+        logger.info(f"Similarity search completed in {elapsed_time:.2f} seconds")
+    except Exception as query_error:
+        elapsed_time = time.time() - start_time
+        logger.error(f"Similarity search failed after {elapsed_time:.2f} seconds: {str(query_error)}")
+        raise
+    
+    # Format results for return and database storage
+    formatted_results, similar_questions_for_db = _format_matches(similar_results)
+    
+    # Store the similar questions in the database
+    if similar_questions_for_db:
+        _store_similar_questions(connection, requirement_id, similar_questions_for_db)
+        
+        # Commit the transaction
+        connection.commit()
+        logger.info(f"Updated similar_questions in database for requirement ID: {requirement_id}")
+    
+    # For debug/console output in logs only, buffered into a single record
+    # so the handler writes and flushes once instead of once per line
+    if logger.isEnabledFor(logging.INFO):
+        lines = [
+            f"Original Requirement: ID={requirement[0]}, Category={requirement[2]}",
+            f"Requirement text: {requirement[1]}",
+            f"Found {len(similar_results)} similar matches"
+        ]
+        for idx, result in enumerate(similar_results, 1):
+            lines.extend([
+                f"Match #{idx}",
+                f"ID: {result[0]}",
+                f"Category: {result[3]}",
+                f"Similarity Score: {float(result[6]):.4f}",
+                f"Requirement: {result[1]}",
+                f"Response: {result[2][:100]}...",  # Log only the first 100 chars
+                "-" * 40
+            ])
+        logger.info("\n".join(lines))
+    
+    # Return structured data
+    return {
+        "success": True,
+        "requirement": {
+            "id": requirement[0],
+            "text": requirement[1],
+            "category": requirement[2]
+        },
+        "similar_matches": formatted_results
+    }
+
+def _format_matches(similar_results):
+    """
+    Format similarity search rows for the API response and for database storage.
+
+    Args:
+        similar_results: Rows of (id, requirement, response, category, reference, payload, similarity_score)
+
+    Returns:
+        Tuple of (formatted_results, similar_questions_for_db)
+    """
+    formatted_results = []
+    similar_questions_for_db = []
+    
+    for match_id, matched_requirement, matched_response, category, reference, payload, similarity_score in similar_results:
+        similarity_score = float(similarity_score)
+        
+        # Document name is in the reference column - this is what we want to display
+        document_name = reference or ""  # e.g., "BDO RFI.xlsx_Sheet1"
+        
+        # Customer/category info from category field
+        customer_info = category or ""
+        
+        # Last resort: try payload for customer info
+        if not customer_info and payload:
+            try:
+                customer_info = json.loads(payload).get('category') or ""
+            except Exception as e:
+                logger.debug(f"Could not parse payload for customer info: {e}")
+        
+        # Format for API response
+        formatted_results.append({
+            "id": match_id,
+            "requirement": matched_requirement,
+            "response": matched_response,
+            "category": customer_info,  # Category field for display
+            "reference": document_name,  # Document name from reference column
+            "customer": customer_info,   # Customer info for backwards compatibility
+            "similarity_score": similarity_score
+        })
+        
+        # Format for database storage (includes document name)
+        similar_questions_for_db.append({
+            "question": matched_requirement,
+            "response": matched_response,
+            "reference": document_name,  # Use document name instead of "Match #X"
+            "customer": customer_info,
+            "similarity_score": f"{similarity_score:.4f}"
+        })
+    
+    return formatted_results, similar_questions_for_db
+
+def _store_similar_questions(connection, requirement_id, similar_questions_for_db):
+    """Write the formatted similar questions to excel_requirement_responses (no commit)."""
+    # Convert to JSON string for storage
+    similar_questions_json = json.dumps(similar_questions_for_db)
+    
+    # Update the similar_questions column in the database
+    update_query = text("""
+        UPDATE excel_requirement_responses
+        SET similar_questions = :similar_questions
+        WHERE id = :req_id
+    """)
+    
+    connection.execute(update_query, {
+        "req_id": requirement_id,
+        "similar_questions": similar_questions_json
+    })
+
+def find_similar_matches_batch(requirement_ids, connection=None, limit=SIMILAR_MATCH_LIMIT, min_similarity=None):
+    """
+    Find similar matches for several requirements at once.
+    Embeddings for all requirements are generated in one API call and the
+    similarity search for all of them runs as a single SQL statement.
+    
+    Args:
+        requirement_ids: List of requirement IDs to find matches for
+        connection: Optional open database connection to reuse
+        limit: Number of matches to return per requirement
+        min_similarity: Optional minimum similarity score, applied in SQL
+        
+    Returns:
+        Dict with a list of per-requirement results shaped like find_similar_matches,
+        in requirement_ids order, each carrying its requirement_id
+    """
+    logger.info(f"Finding similar matches for {len(requirement_ids)} requirements")
+    shared_connection = connection
+    try:
+        if shared_connection is not None:
+            return _find_similar_matches_batch(shared_connection, requirement_ids, limit, min_similarity)
+        with engine.connect() as connection:
+            return _find_similar_matches_batch(connection, requirement_ids, limit, min_similarity)
     except Exception as e:
-        logger.error(f"Error finding similar matches: {str(e)}")
+        logger.error(f"Error finding similar matches in batch: {str(e)}")
+        if shared_connection is not None:
+            shared_connection.rollback()
         return {
             "success": False,
             "error": str(e)
         }
 
+def _missing_requirement(req_id):
+    """Batch result entry for a requirement ID that does not exist."""
+    return {
+        "success": False,
+        "requirement_id": req_id,
+        "error": f"No requirement found with ID: {req_id}"
+    }
+
+def _find_similar_matches_batch(connection, requirement_ids, limit, min_similarity=None):
+    """Run the batched similarity search on an open connection."""
+    req_query = text("""
+        SELECT r.id, r.requirement, r.category
+        FROM excel_requirement_responses r
+        WHERE r.id = ANY(:req_ids)
+    """)
+    found = {row[0]: row for row in connection.execute(req_query, {"req_ids": list(requirement_ids)}).fetchall()}
+    requirements = list(found.values())
+    
+    if not requirements:
+        return {"success": True, "results": [_missing_requirement(req_id) for req_id in requirement_ids]}
+    
+    # One embeddings API call for every requirement in the batch
+    try:
+        generator = EmbeddingGenerator(OPENAI_API_KEY)
+        embeddings = generator.generate_embedding_batch([requirement[1] for requirement in requirements])
+    except Exception as e:
+        logger.error(f"Error generating temporary embeddings: {str(e)}")
+        return {
+            "success": False,
+            "error": f"Failed to generate embeddings: {str(e)}"
+        }
+    
+    # kNN for every query vector in one round-trip via unnest + LATERAL,
+    # reranking the oversampled halfvec candidates at full precision
+    batch_query = text("""
+        SELECT 
+            q.idx,
+            m.id,
+            m.matched_requirement,
+            m.matched_response,
+            m.category,
+            m.reference,
+            m.payload,
+            -m.distance as similarity_score
+        FROM unnest(CAST(:embeddings AS vector[])) WITH ORDINALITY AS u(v, idx)
+        CROSS JOIN LATERAL (SELECT l2_normalize(u.v) AS v, u.idx AS idx) q
+        CROSS JOIN LATERAL (
+            SELECT 
+                c.id,
+                c.matched_requirement,
+                c.matched_response,
+                c.category,
+                c.reference,
+                c.payload,
+                c.embedding <#> q.v as distance
+            FROM (
+                SELECT 
+                    e.id,
+                    e.requirement as matched_requirement,
+                    e.response as matched_response,
+                    e.category,
+                    e.reference,
+                    e.payload,
+                    e.embedding
+                FROM embeddings e
+                WHERE e.embedding IS NOT NULL
+                ORDER BY e.embedding::halfvec(1536) <#> q.v::halfvec(1536)
+                LIMIT :candidates
+            ) c
+            ORDER BY distance
+            LIMIT :limit
+        ) m
+        WHERE m.distance <= :max_distance
+        ORDER BY q.idx, m.distance;
+    """)
+    
+    start_time = time.time()
+    _set_hnsw_ef_search(connection, limit * RERANK_OVERSAMPLE)
+    # Only very large batches go through a server-side cursor; for typical
+    # sizes its DECLARE/FETCH/CLOSE round-trips cost more than one fetch
+    if len(requirements) * limit >= BATCH_STREAM_MIN_ROWS:
+        batch_query = batch_query.execution_options(stream_results=True, yield_per=BATCH_STREAM_YIELD_PER)
+    rows = connection.execute(
+        batch_query,
+        {
+            "embeddings": [to_pgvector(embedding) for embedding in embeddings],
+            "limit": limit,
+            "candidates": limit * RERANK_OVERSAMPLE,
+            "max_distance": _max_distance(min_similarity)
+        }
+    )
+    
+    # Group rows back by query position (ordinality is 1-based)
+    grouped = [[] for _ in requirements]
+    for row in rows:
+        grouped[row[0] - 1].append(tuple(row[1:]))
+    logger.info(f"Batch similarity search for {len(requirements)} requirements completed in {time.time() - start_time:.2f} seconds")
+    
+    # Per-requirement results by ID, returned in requirement_ids order
+    matches = {}
+    for requirement, similar_results in zip(requirements, grouped):
+        formatted_results, similar_questions_for_db = _format_matches(similar_results)
+        if similar_questions_for_db:
+            _store_similar_questions(connection, requirement[0], similar_questions_for_db)
+        matches[requirement[0]] = {
+            "success": True,
+            "requirement_id": requirement[0],
+            "requirement": {
+                "id": requirement[0],
+                "text": requirement[1],
+                "category": requirement[2]
+            },
+            "similar_matches": formatted_results
+        }
+    
+    connection.commit()
+    logger.info(f"Updated similar_questions in database for {len(requirements)} requirements")
+    
+    return {
+        "success": True,
+        "results": [matches.get(req_id) or _missing_requirement(req_id) for req_id in requirement_ids]
+    }
+
 if __name__ == "__main__":
     import sys
     
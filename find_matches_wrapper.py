@@ -6,22 +6,25 @@ Accepts arguments via command line to avoid shell injection
 import sys
 import json
 import traceback
-from find_matches import find_similar_matches
+from find_matches import find_similar_matches, find_similar_matches_batch
 
 def main():
     if len(sys.argv) < 2:
         print(json.dumps({
             'success': False,
-            'error': 'Usage: find_matches_wrapper.py <requirement_id>'
+            'error': 'Usage: find_matches_wrapper.py <requirement_id>[,<requirement_id>...]'
         }))
         sys.exit(1)
     
     try:
         # Parse arguments safely
-        requirement_id = int(sys.argv[1])
+        requirement_ids = [int(id) for id in sys.argv[1].split(',')]
         
-        # Call the function
-        result = find_similar_matches(requirement_id)
+        # Call the function (several IDs are searched in one batch)
+        if len(requirement_ids) == 1:
+            result = find_similar_matches(requirement_ids[0])
+        else:
+            result = find_similar_matches_batch(requirement_ids)
         
         # Output JSON result
         print(json.dumps(result))
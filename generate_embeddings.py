@@ -7,23 +7,145 @@ import json
 import logging
 from typing import List, Dict, Any, Optional
 from openai import OpenAI
-from database import engine
+from psycopg2.extras import execute_values
+from config import OPENAI_API_KEY
+from clients import get_client
+from database import engine, to_pgvector
 from sqlalchemy import text
 import time
+import threading
+import hashlib
+import sqlite3
+from array import array
+from collections import OrderedDict
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Process-wide LRU of embeddings keyed by (model, whitespace-normalized text)
+EMBEDDING_CACHE_SIZE = 4096
+_embedding_cache = OrderedDict()
+_embedding_cache_lock = threading.Lock()
+
+def _cache_key(model: str, input_text: str) -> tuple:
+    """Build the embedding cache key; whitespace differences do not change the key"""
+    return (model, ' '.join(input_text.split()))
+
+# On-disk embedding cache shared by every process on the host, so re-runs of
+# the same RFP skip the API; set EMBEDDING_CACHE_PATH to an empty string to disable
+EMBEDDING_CACHE_PATH = os.environ.get(
+    'EMBEDDING_CACHE_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '.embedding_cache.sqlite3')
+)
+_disk_cache = None
+_disk_cache_lock = threading.Lock()
+
+def _disk_key(key: tuple) -> bytes:
+    """Hash an in-process cache key into the on-disk cache key"""
+    model, input_text = key
+    return hashlib.sha256(f"{model}\n{input_text}".encode('utf-8')).digest()
+
+def _get_disk_cache() -> Optional[sqlite3.Connection]:
+    """Open the on-disk cache on first use; returns None when it is disabled or unavailable"""
+    global _disk_cache, EMBEDDING_CACHE_PATH
+    if _disk_cache is None and EMBEDDING_CACHE_PATH:
+        try:
+            connection = sqlite3.connect(EMBEDDING_CACHE_PATH, timeout=5, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS embeddings (key BLOB PRIMARY KEY, vector BLOB NOT NULL)")
+            _disk_cache = connection
+        except sqlite3.Error as e:
+            logger.warning(f"On-disk embedding cache disabled: {str(e)}")
+            EMBEDDING_CACHE_PATH = ''
+    return _disk_cache
+
+def _disk_cache_get(key: tuple) -> Optional[List[float]]:
+    with _disk_cache_lock:
+        connection = _get_disk_cache()
+        if connection is None:
+            return None
+        try:
+            row = connection.execute("SELECT vector FROM embeddings WHERE key = ?", (_disk_key(key),)).fetchone()
+        except sqlite3.Error as e:
+            logger.warning(f"Error reading on-disk embedding cache: {str(e)}")
+            return None
+    if row is None:
+        return None
+    # Vectors are stored as float32, the precision pgvector keeps anyway
+    vector = array('f')
+    vector.frombytes(row[0])
+    return vector.tolist()
+
+def _disk_cache_put_many(items: List[tuple]) -> None:
+    with _disk_cache_lock:
+        connection = _get_disk_cache()
+        if connection is None:
+            return
+        try:
+            with connection:
+                connection.executemany(
+                    "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                    [(_disk_key(key), array('f', embedding).tobytes()) for key, embedding in items]
+                )
+        except sqlite3.Error as e:
+            logger.warning(f"Error writing on-disk embedding cache: {str(e)}")
+
+def _memory_cache_put(key: tuple, embedding: List[float]) -> None:
+    with _embedding_cache_lock:
+        _embedding_cache[key] = tuple(embedding)
+        _embedding_cache.move_to_end(key)
+        if len(_embedding_cache) > EMBEDDING_CACHE_SIZE:
+            _embedding_cache.popitem(last=False)
+
+def _cache_get(key: tuple) -> Optional[List[float]]:
+    with _embedding_cache_lock:
+        embedding = _embedding_cache.get(key)
+        if embedding is not None:
+            _embedding_cache.move_to_end(key)
+            return list(embedding)
+    embedding = _disk_cache_get(key)
+    if embedding is not None:
+        _memory_cache_put(key, embedding)
+    return embedding
+
+def _cache_put_many(items: List[tuple]) -> None:
+    """Store (key, embedding) pairs in the in-process and on-disk caches"""
+    for key, embedding in items:
+        _memory_cache_put(key, embedding)
+    _disk_cache_put_many(items)
+
+def _cache_put(key: tuple, embedding: List[float]) -> None:
+    _cache_put_many([(key, embedding)])
+
+# Limits for a single embeddings request: OpenAI accepts at most 2048 inputs
+# and 300k tokens; a token is never shorter than one character, so capping
+# characters at the token limit keeps any text (CJK, digits, code) under it
+MAX_INPUTS_PER_REQUEST = 2048
+MAX_CHARS_PER_REQUEST = 300000
+
+def _request_chunks(items: List[tuple]):
+    """Split (key, text) pairs into chunks that fit in one embeddings request"""
+    chunk, chars = [], 0
+    for key, chunk_text in items:
+        if chunk and (len(chunk) == MAX_INPUTS_PER_REQUEST or chars + len(chunk_text) > MAX_CHARS_PER_REQUEST):
+            yield chunk
+            chunk, chars = [], 0
+        chunk.append((key, chunk_text))
+        chars += len(chunk_text)
+    if chunk:
+        yield chunk
+
 class EmbeddingGenerator:
     def __init__(self, api_key: str):
         """Initialize the embedding generator with OpenAI API key"""
-        self.client = OpenAI(api_key=api_key)
+        self.client = get_client(OpenAI, api_key=api_key)
         self.model = "text-embedding-3-small"  # Updated model for better performance
         
     def generate_embedding(self, text: str) -> List[float]:
         """
         Generate embedding for a single text using OpenAI API
+        Repeated texts are served from the in-process or on-disk cache without an API call
         
         Args:
             text: The text to generate embedding for
@@ -31,19 +153,26 @@ class EmbeddingGenerator:
         Returns:
             List of floats representing the embedding vector
         """
+        key = _cache_key(self.model, text)
+        cached = _cache_get(key)
+        if cached is not None:
+            return cached
         try:
             response = self.client.embeddings.create(
                 model=self.model,
                 input=text
             )
-            return response.data[0].embedding
+            embedding = response.data[0].embedding
+            _cache_put(key, embedding)
+            return embedding
         except Exception as e:
             logger.error(f"Error generating embedding: {str(e)}")
             raise
     
     def generate_embedding_batch(self, texts: List[str]) -> List[List[float]]:
         """
-        Generate embeddings for multiple texts in one API call (batch processing)
+        Generate embeddings for multiple texts in as few API calls as possible (batch processing)
+        Cached texts are skipped and repeated texts are sent only once
         
         Args:
             texts: List of texts to generate embeddings for
@@ -51,12 +180,25 @@ class EmbeddingGenerator:
         Returns:
             List of embedding vectors
         """
+        keys = [_cache_key(self.model, input_text) for input_text in texts]
+        embeddings = [_cache_get(key) for key in keys]
+        
+        # Positions of every text still missing an embedding, grouped by cache key
+        pending = {}
+        for i, (key, embedding) in enumerate(zip(keys, embeddings)):
+            if embedding is None:
+                pending.setdefault(key, []).append(i)
         try:
-            response = self.client.embeddings.create(
-                model=self.model,
-                input=texts
-            )
-            return [item.embedding for item in response.data]
+            for chunk in _request_chunks([(key, texts[positions[0]]) for key, positions in pending.items()]):
+                response = self.client.embeddings.create(
+                    model=self.model,
+                    input=[chunk_text for _, chunk_text in chunk]
+                )
+                for (key, _), item in zip(chunk, response.data):
+                    for i in pending[key]:
+                        embeddings[i] = item.embedding
+                _cache_put_many([(key, item.embedding) for (key, _), item in zip(chunk, response.data)])
+            return embeddings
         except Exception as e:
             logger.error(f"Error generating batch embeddings: {str(e)}")
             raise
@@ -89,7 +231,7 @@ class EmbeddingGenerator:
                         LEFT JOIN embeddings e ON e.requirement = r.requirement
                         WHERE r.id = ANY(:ids) AND e.id IS NULL
                     """)
-                    requirements = connection.execute(query, {"ids": requirement_ids}).fetchall()
+                    params = {"ids": requirement_ids}
                 else:
                     query = text("""
                         SELECT r.id, r.requirement, r.category, r.final_response
@@ -97,19 +239,24 @@ class EmbeddingGenerator:
                         LEFT JOIN embeddings e ON e.requirement = r.requirement
                         WHERE e.id IS NULL
                     """)
-                    requirements = connection.execute(query).fetchall()
-                
-                logger.info(f"Found {len(requirements)} requirements to process")
+                    params = {}
                 
-                if len(requirements) == 0:
-                    return stats
+                # Stream requirements through a server-side cursor one batch at a
+                # time instead of materializing the whole backlog up front
+                requirements = connection.execute(
+                    query.execution_options(stream_results=True, yield_per=batch_size), params
+                )
                 
                 # Process in batches for API efficiency
-                for batch_start in range(0, len(requirements), batch_size):
-                    batch = requirements[batch_start:batch_start + batch_size]
-                    batch_end = min(batch_start + batch_size, len(requirements))
+                for batch in requirements.partitions(batch_size):
+                    batch_start = stats['total_processed']
+                    batch_end = batch_start + len(batch)
                     
-                    logger.info(f"Processing batch {batch_start+1}-{batch_end} of {len(requirements)} requirements")
+                    # Rate limiting between batches
+                    if batch_start > 0:
+                        time.sleep(1)
+                    
+                    logger.info(f"Processing requirements {batch_start+1}-{batch_end}")
                     
                     try:
                         # Prepare batch data
@@ -133,45 +280,50 @@ class EmbeddingGenerator:
                         
                         # Bulk insert all embeddings
                         # Note: Use raw SQL with proper casting for pgvector
+                        # Vectors are stored unit-length so search can rank by inner product
                         insert_query = """
                             INSERT INTO embeddings (
                                 category, requirement, response, reference, 
                                 payload, embedding
-                            ) VALUES (
-                                %(category)s, %(requirement)s, %(response)s, %(reference)s,
-                                %(payload)s, %(embedding)s::vector
-                            )
+                            ) VALUES %s
                         """
+                        insert_template = """(
+                            %(category)s, %(requirement)s, %(response)s, %(reference)s,
+                            %(payload)s, l2_normalize(%(embedding)s::vector)
+                        )"""
                         
-                        # Insert each embedding individually within the transaction
-                        for i, (data, embedding) in enumerate(zip(batch_data, embedding_vectors)):
-                            vector_str = '[' + ','.join(map(str, embedding)) + ']'
+                        insert_rows = []
+                        for data, embedding in zip(batch_data, embedding_vectors):
                             metadata = {
                                 'category': data['category'],
                                 'source': 'uploaded_requirement'
                             }
                             
-                            insert_params = {
+                            insert_rows.append({
                                 "category": data['category'],
                                 "requirement": data['requirement'],
                                 "response": data['response'],
                                 "reference": f"REQ-{data['id']}",
                                 "payload": json.dumps(metadata),
-                                "embedding": vector_str
-                            }
-                            
-                            # Execute raw SQL with psycopg2 (not SQLAlchemy text())
-                            connection.connection.cursor().execute(insert_query, insert_params)
+                                "embedding": to_pgvector(embedding)
+                            })
+                        
+                        # One multi-row INSERT for the whole batch
+                        # Execute raw SQL with psycopg2 (not SQLAlchemy text())
+                        # Each batch runs in its own savepoint, so a failed INSERT
+                        # rolls back only that batch and the streaming cursor stays usable
+                        with connection.begin_nested():
+                            with connection.connection.cursor() as cursor:
+                                execute_values(
+                                    cursor, insert_query, insert_rows,
+                                    template=insert_template, page_size=len(insert_rows)
+                                )
                         
                         # Transaction is auto-committed when exiting begin() context
                         
                         stats['total_created'] += len(batch)
                         stats['total_processed'] += len(batch)
                         logger.info(f"✓ Successfully created {len(batch)} embeddings")
-                        
-                        # Rate limiting between batches
-                        if batch_end < len(requirements):
-                            time.sleep(1)
                             
                     except Exception as e:
                         error_msg = f"Error processing batch {batch_start+1}-{batch_end}: {str(e)}"
@@ -192,7 +344,7 @@ class EmbeddingGenerator:
 def main():
     """Main function for command-line usage"""
     # Get API key from environment
-    api_key = os.environ.get('OPENAI_API_KEY')
+    api_key = OPENAI_API_KEY
     if not api_key:
         print(json.dumps({
             'success': False,
@@ -231,8 +231,8 @@ def find_similar_matches_and_generate_prompt(requirement_id: int) -> List[Dict[s
                 logger.error(f"No requirement found with ID: {requirement_id}")
                 return create_rfp_prompt(f"Missing requirement with ID {requirement_id}")
         
-        # Find similar matches
-        matches_result = find_similar_matches(requirement_id)
+            # Find similar matches on the same connection
+            matches_result = find_similar_matches(requirement_id, connection, requirement)
         
         if not matches_result.get("success", False):
             logger.error(f"Error finding similar matches: {matches_result.get('error', 'Unknown error')}")
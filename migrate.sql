@@ -29,3 +29,13 @@ ALTER TABLE excel_requirement_responses ADD COLUMN IF NOT EXISTS ekg_subrequirem
 ALTER TABLE excel_requirement_responses ADD COLUMN IF NOT EXISTS ekg_references text;
 ALTER TABLE excel_requirement_responses ADD COLUMN IF NOT EXISTS ekg_raw_response text;
 ALTER TABLE excel_requirement_responses ADD COLUMN IF NOT EXISTS ekg_subrequirements_available text;
+
+-- Add an HNSW index for similarity search on embeddings
+-- Vectors are indexed at half precision (halfvec, pgvector >= 0.7), which halves the index size
+-- Embeddings are stored unit-length, so inner product ranks exactly like cosine
+-- without the per-comparison norm computation
+CREATE EXTENSION IF NOT EXISTS vector;
+UPDATE embeddings SET embedding = l2_normalize(embedding)
+WHERE embedding IS NOT NULL AND abs(vector_norm(embedding) - 1) > 1e-6;
+DROP INDEX IF EXISTS embeddings_vector_idx;
+CREATE INDEX IF NOT EXISTS embeddings_emb_halfvec_ip_hnsw ON embeddings USING hnsw ((embedding::halfvec(1536)) halfvec_ip_ops) WITH (m = 24, ef_construction = 128);